@@ -1,7 +1,8 @@
 import copy, time, traceback, logging, os, gc
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
-from sklearn.neighbors import NearestNeighbors
+from scipy.spatial import cKDTree
 
 from ..constants import BINARY, MULTICLASS, REGRESSION, SOFTCLASS
 from ..models.tabular_nn.tabular_nn_model import TabularNeuralNetModel
@@ -10,15 +11,57 @@ from ...metrics import mean_squared_error
 
 logger = logging.getLogger(__name__)
 
+try:
+    from numba import njit, prange
+    _numba_available = True
+except ImportError:
+    _numba_available = False
 
-def format_distillation_labels(y, problem_type, num_classes=None, eps_labelsmooth=0.01):
+if _numba_available:
+    @njit(parallel=True, fastmath=True)
+    def _munge_perturb_kernel(orig, nbr, perturb_mask, cont_col_mask, s, noise, out):
+        """ Fused MUNGE perturbation: reads orig/nbr and writes out in a single pass, avoiding the large temporaries of the NumPy fallback path.
+            noise is a pre-drawn standard-normal matrix (from the caller's seeded generator, keeping the seed contract) that the kernel scales in place of per-cell draws. """
+        for i in prange(orig.shape[0]):
+            for j in range(orig.shape[1]):
+                if perturb_mask[i, j]:
+                    new_val = nbr[i, j]
+                    if cont_col_mask[j]:
+                        new_val += noise[i, j] * np.abs(orig[i, j] - new_val) / s
+                    out[i, j] = new_val
+                else:
+                    out[i, j] = orig[i, j]
+
+    @njit(parallel=True)
+    def _onehot_labels(y_int, num_classes):
+        """ Parallel one-hot fill: rows are written concurrently instead of serially memsetting then scattering. """
+        out = np.zeros((y_int.size, num_classes), dtype=np.float32)
+        for i in prange(y_int.size):
+            out[i, y_int[i]] = 1.0
+        return out
+
+
+MAX_ONEHOT_GATHER_CLASSES = 64  # one-hot via np.eye row-gather up to this many classes; scatter writes beyond it
+
+
+def format_distillation_labels(y, problem_type, num_classes=None, eps_labelsmooth=0.01, sparse=False):
     """ Transforms train/test label objects (y) to the correct type for distillation (smoothed regression targets for binary, one-hot labels for multiclass).
         eps_labelsmooth : truncates labels to [EPS, 1-EPS], eg. when converting binary problems -> regression
+        sparse : if True, multiclass labels are returned as a scipy.sparse.csr_matrix instead of a DataFrame (for memory-critical runs with many classes).
+        Multiclass labels are returned as float32, matching the fp32 teacher predictions they are mixed with downstream (and halving label-matrix memory vs float64).
     """
     if problem_type == MULTICLASS:
         y_int = y.to_numpy()
-        y = np.zeros((y_int.size, num_classes))
-        y[np.arange(y_int.size),y_int] = 1
+        if sparse:
+            from scipy.sparse import csr_matrix
+            return csr_matrix((np.ones(y_int.size, dtype=np.float32), (np.arange(y_int.size), y_int)), shape=(y_int.size, num_classes))
+        if num_classes <= MAX_ONEHOT_GATHER_CLASSES:
+            y = np.eye(num_classes, dtype=np.float32)[y_int]  # single cache-friendly gather, no scatter write
+        elif _numba_available:
+            y = _onehot_labels(np.ascontiguousarray(y_int), num_classes)
+        else:
+            y = np.zeros((y_int.size, num_classes), dtype=np.float32)
+            y[np.arange(y_int.size),y_int] = 1
         y = pd.DataFrame(y)
     elif problem_type == BINARY:
         min_pred = 0.0
@@ -27,8 +70,12 @@ def format_distillation_labels(y, problem_type, num_classes=None, eps_labelsmoot
     return y
 
 
+MIN_SAMPLES_PARALLEL_AUGMENT = 50000  # below this, process startup overhead outweighs the parallel speedup
+
+
 def augment_data(X_train, feature_types_metadata: FeatureTypesMetadata, augmentation_data=None, augment_method='spunge', augment_args=None):
     """ augment_method options: ['spunge', 'munge']
+        augment_args may specify 'num_procs' to shard sample-generation across this many processes.
     """
     if augment_args is None:
         augment_args = {}
@@ -41,27 +88,54 @@ def augment_data(X_train, feature_types_metadata: FeatureTypesMetadata, augmenta
             augment_args['num_augmented_samples'] = int(min(augment_args['max_size'], augment_args['size_factor']*len(X_train)))
 
         if augment_method == 'spunge':
-            X_aug = spunge_augment(X_train, feature_types_metadata, **augment_args)
+            augment_fn = spunge_augment
         elif augment_method == 'munge':
-            X_aug = munge_augment(X_train, feature_types_metadata, **augment_args)
+            augment_fn = munge_augment
         else:
             raise ValueError(f"unknown augment_method: {augment_method}")
 
+        num_procs = augment_args.get('num_procs', 1)
+        if num_procs > 1 and augment_args['num_augmented_samples'] >= MIN_SAMPLES_PARALLEL_AUGMENT:
+            X_aug = _augment_data_parallel(augment_fn, X_train, feature_types_metadata, augment_args, num_procs)
+        else:
+            X_aug = augment_fn(X_train, feature_types_metadata, **augment_args)
+
     # return postprocess_augmented(X_aug, X_train)  # TODO: dropping duplicates is much more efficient, but may skew distribution for entirely-categorical data with few categories.
     logger.log(15, f"Augmented training dataset with {len(X_aug)} extra datapoints")
     return X_aug.reset_index(drop=True)
 
 
+def _augment_data_parallel(augment_fn, X, feature_types_metadata, augment_args, num_procs):
+    """ Shards num_augmented_samples across num_procs worker processes, each drawing its slice with an independently spawned child seed, and concatenates the results. """
+    num_augmented_samples = augment_args['num_augmented_samples']
+    shard_sizes = [len(shard) for shard in np.array_split(np.arange(num_augmented_samples), num_procs) if len(shard) > 0]
+    child_seeds = np.random.SeedSequence(augment_args.get('seed', None)).spawn(len(shard_sizes))
+    futures = []
+    with ProcessPoolExecutor(max_workers=len(shard_sizes)) as executor:
+        for shard_size, child_seed in zip(shard_sizes, child_seeds):
+            shard_args = dict(augment_args, num_augmented_samples=shard_size, seed=child_seed)
+            if 'n_jobs' not in shard_args:
+                # split the cores among the workers so munge's neighbor query does not oversubscribe them with num_procs x n_cores threads
+                shard_args['n_jobs'] = max(1, (os.cpu_count() or 1) // len(shard_sizes))
+            futures.append(executor.submit(augment_fn, X, feature_types_metadata, **shard_args))
+        return pd.concat([future.result() for future in futures], ignore_index=True)
+
+
 def postprocess_augmented(X_aug, X):
     """ Drops rows from augmented data that are duplicated (including duplicates that appeared in original data X). """
-    X_aug = pd.concat([X, X_aug])
-    X_aug.drop_duplicates(keep='first', inplace=True)
-    X_aug = X_aug.tail(len(X_aug)-len(X))
+    # Compare 64-bit row hashes rather than concatenating the frames: avoids copying X + X_aug into a
+    # temporary frame just to discard the X rows again afterwards. Hashing is dtype-sensitive and the
+    # augment functions cast continuous columns to float, so X is hashed under X_aug's dtypes (as the
+    # old concat did implicitly) to keep unperturbed copies of X rows matching.
+    real_hashes = pd.util.hash_pandas_object(X.astype(X_aug.dtypes.to_dict()), index=False)
+    aug_hashes = pd.util.hash_pandas_object(X_aug, index=False)
+    keep = (~aug_hashes.duplicated(keep='first') & ~aug_hashes.isin(real_hashes)).to_numpy()
+    X_aug = X_aug[keep]
     logger.log(15, f"Augmented training dataset with {len(X_aug)} extra datapoints")
     return X_aug.reset_index(drop=True, inplace=False)
 
 
-def spunge_augment(X, feature_types_metadata: FeatureTypesMetadata, num_augmented_samples=10000, frac_perturb=0.1, continuous_feature_noise=0.1, **kwargs):
+def spunge_augment(X, feature_types_metadata: FeatureTypesMetadata, num_augmented_samples=10000, frac_perturb=0.1, continuous_feature_noise=0.1, seed=None, **kwargs):
     """ Generates synthetic datapoints for learning to mimic teacher model in distillation
         via simplified version of MUNGE strategy (that does not require near-neighbor search).
 
@@ -69,47 +143,85 @@ def spunge_augment(X, feature_types_metadata: FeatureTypesMetadata, num_augmente
             num_augmented_samples: number of additional augmented data points to return
             frac_perturb: fraction of features/examples that are perturbed during augmentation. Set near 0 to ensure augmented sample distribution remains closer to real data.
             continuous_feature_noise: we noise numeric features by this factor times their std-dev. Set near 0 to ensure augmented sample distribution remains closer to real data.
+            seed: seed for the random generator used to produce the augmented samples (None for nondeterministic output).
     """
     if frac_perturb > 1.0:
         raise ValueError("frac_perturb must be <= 1")
     logger.log(20, f"SPUNGE: Augmenting training data with {num_augmented_samples} synthetic samples for distillation...")
+    rng = np.random.default_rng(seed)
     num_feature_perturb = max(1, int(frac_perturb*len(X.columns)))
-    X_aug = pd.concat([X.iloc[[0]].copy()]*num_augmented_samples)
-    X_aug.reset_index(drop=True, inplace=True)
+    num_cols = len(X.columns)
+    og_ind = np.arange(num_augmented_samples) % len(X)
     continuous_types = ['float', 'int']
     continuous_featnames = [] # these features will have shuffled values with added noise
     for contype in continuous_types:
         if contype in feature_types_metadata.feature_types_raw:
             continuous_featnames += feature_types_metadata.feature_types_raw[contype]
 
-    for i in range(num_augmented_samples): # hot-deck sample some features per datapoint
-        og_ind = i % len(X)
-        augdata_i = X.iloc[og_ind].copy()
-        num_feature_perturb_i = np.random.choice(range(1,num_feature_perturb+1))  # randomly sample number of features to perturb
-        cols_toperturb = np.random.choice(list(X.columns), size=num_feature_perturb_i, replace=False)
-        for feature in cols_toperturb:
-            feature_data = X[feature]
-            augdata_i[feature] = feature_data.sample(n=1).values[0]
-        X_aug.iloc[i] = augdata_i
+    if len(continuous_featnames) > 0 and set(continuous_featnames) == set(X.columns):  # common after preprocessing
+        out = _spunge_augment_numeric(np.ascontiguousarray(X.to_numpy(), dtype=np.float32), rng, num_augmented_samples, num_feature_perturb, frac_perturb, continuous_feature_noise)
+        return pd.DataFrame(out, columns=X.columns)
 
-    for feature in X.columns:
-        if feature in continuous_featnames:
-            feature_data = X[feature]
-            aug_data = X_aug[feature]
-            noise = np.random.normal(scale=np.nanstd(feature_data)*continuous_feature_noise, size=num_augmented_samples)
-            mask = np.random.binomial(n=1, p=frac_perturb, size=num_augmented_samples)
-            aug_data = aug_data + noise*mask
-            X_aug[feature] = pd.Series(aug_data, index=X_aug.index)
+    # hot-deck sample some features per datapoint: per row, perturb a uniformly drawn subset of
+    # k ~ Uniform{1,...,num_feature_perturb} features (ranking one random matrix replaces N choice() calls)
+    num_feature_perturb_per_row = rng.integers(1, num_feature_perturb+1, size=num_augmented_samples)
+    perturb_mask = rng.random((num_augmented_samples, num_cols)).argsort(axis=1) < num_feature_perturb_per_row[:, None]
+    sampled_ind = rng.integers(0, len(X), size=(num_augmented_samples, num_cols))
+    # fill per-column typed buffers and assemble the DataFrame once at the end, keeping pandas out of the hot path
+    col_data = {}
+    for j, feature in enumerate(X.columns):
+        feature_data = X[feature].to_numpy()
+        aug_col = feature_data[og_ind]
+        mask_j = perturb_mask[:, j]
+        if mask_j.any():
+            aug_col[mask_j] = feature_data[sampled_ind[mask_j, j]]
+        col_data[feature] = aug_col
 
+    if len(continuous_featnames) > 0:
+        stds = np.nanstd(X[continuous_featnames].to_numpy(dtype=np.float64), axis=0)
+        noise = rng.normal(size=(num_augmented_samples, len(continuous_featnames))) * (stds * continuous_feature_noise)
+        noise_mask = rng.binomial(n=1, p=frac_perturb, size=(num_augmented_samples, len(continuous_featnames)))
+        for j, feature in enumerate(continuous_featnames):
+            col_data[feature] = col_data[feature].astype(np.float64) + noise[:, j]*noise_mask[:, j]
+
+    X_aug = pd.DataFrame(col_data, columns=list(X.columns), copy=False)
+    for feature in X.columns:
+        if feature not in continuous_featnames and X_aug[feature].dtype != X[feature].dtype:
+            X_aug[feature] = X_aug[feature].astype(X[feature].dtype)  # categorical columns round-trip through object buffers
     return X_aug
 
 
-def munge_augment(X, feature_types_metadata: FeatureTypesMetadata, num_augmented_samples=10000, perturb_prob=0.5, s=1.0, **kwargs):
+def _spunge_augment_numeric(Xnp, rng, num_augmented_samples, num_feature_perturb, frac_perturb, continuous_feature_noise):
+    """ spunge_augment fast path for frames whose features are all continuous: every feature is hot-deck sampled and noised on a single fp32 matrix, with no per-column pandas access. """
+    num_rows, num_cols = Xnp.shape
+    out = Xnp[np.arange(num_augmented_samples) % num_rows]
+    num_feature_perturb_per_row = rng.integers(1, num_feature_perturb+1, size=num_augmented_samples)
+    perturb_mask = rng.random((num_augmented_samples, num_cols)).argsort(axis=1) < num_feature_perturb_per_row[:, None]
+    sampled_vals = Xnp[rng.integers(0, num_rows, size=(num_augmented_samples, num_cols)), np.arange(num_cols)]
+    out[perturb_mask] = sampled_vals[perturb_mask]
+    stds = np.nanstd(Xnp, axis=0)
+    noise = rng.standard_normal((num_augmented_samples, num_cols), dtype=np.float32) * (stds * continuous_feature_noise)
+    noise_mask = rng.random((num_augmented_samples, num_cols)) < frac_perturb
+    out += noise * noise_mask
+    return out
+
+
+def _kdtree_query(kdtree, x, k, num_threads):
+    """ Multithreaded cKDTree.query: scipy renamed the thread-count argument from n_jobs to workers in 1.6 and removed n_jobs in 1.9, and setup.py does not pin an upper scipy bound. """
+    try:
+        return kdtree.query(x, k=k, workers=num_threads)
+    except TypeError:
+        return kdtree.query(x, k=k, n_jobs=num_threads)
+
+
+def munge_augment(X, feature_types_metadata: FeatureTypesMetadata, num_augmented_samples=10000, perturb_prob=0.5, s=1.0, seed=None, n_jobs=-1, **kwargs):
     """ Uses MUNGE algorithm to generate synthetic datapoints for learning to mimic teacher model in distillation: https://www.cs.cornell.edu/~caruana/compression.kdd06.pdf
         Args:
             num_augmented_samples: number of additional augmented data points to return
             perturb_prob: probability of perturbing each feature during augmentation. Set near 0 to ensure augmented sample distribution remains closer to real data.
             s: We noise numeric features by their std-dev divided by this factor (inverse of continuous_feature_noise). Set large to ensure augmented sample distribution remains closer to real data.
+            seed: seed for the random generator used to produce the augmented samples (None for nondeterministic output).
+            n_jobs: number of threads for the nearest-neighbor query (-1 to use all cores). May be passed via augment_args.
     """
     nn_dummy = TabularNeuralNetModel(path='nn_dummy', name='nn_dummy', problem_type=REGRESSION, eval_metric=mean_squared_error,
                                      hyperparameters={'num_dataloading_workers': 0, 'proc.embed_min_categories': np.inf},
@@ -119,45 +231,64 @@ def munge_augment(X, feature_types_metadata: FeatureTypesMetadata, num_augmented
                         max_category_levels=nn_dummy.params['proc.max_category_levels'], skew_threshold=nn_dummy.params['proc.skew_threshold'],
                         embed_min_categories=nn_dummy.params['proc.embed_min_categories'], use_ngram_features=nn_dummy.params['use_ngram_features'])
     X_vector = processed_data.dataset._data[processed_data.vectordata_index].asnumpy()
+    X_vector = np.ascontiguousarray(X_vector, dtype=np.float32)  # halves the retained X_vector buffer; note cKDTree still copies the data into its own float64 array internally
     processed_data = None
     nn_dummy = None
     gc.collect()
 
-    neighbor_finder = NearestNeighbors(n_neighbors=2)
-    neighbor_finder.fit(X_vector)
-    neigh_dist, neigh_ind = neighbor_finder.kneighbors(X_vector)
-    neigh_ind = neigh_ind[:,1]  # contains indices of nearest neighbors
-    neigh_dist = None
-    # neigh_dist = neigh_dist[:,1]  # contains distances to nearest neighbors
-    neighbor_finder = None
+    kdtree = cKDTree(X_vector)
+    # k=2 because the nearest neighbor of each point is itself; distances are discarded immediately rather than kept alive in a local
+    neigh_ind = _kdtree_query(kdtree, X_vector, k=2, num_threads=n_jobs)[1][:,1]  # contains indices of nearest neighbors
+    kdtree = None
     gc.collect()
 
     if perturb_prob > 1.0:
         raise ValueError("frac_perturb must be <= 1")
     logger.log(20, f"MUNGE: Augmenting training data with {num_augmented_samples} synthetic samples for distillation...")
+    rng = np.random.default_rng(seed)
     X = X.copy()
-    X_aug = pd.concat([X.iloc[[0]].copy()]*num_augmented_samples)
-    X_aug.reset_index(drop=True, inplace=True)
     continuous_types = ['float', 'int']
     continuous_featnames = [] # these features will have shuffled values with added noise
     for contype in continuous_types:
         if contype in feature_types_metadata.feature_types_raw:
             continuous_featnames += feature_types_metadata.feature_types_raw[contype]
     for col in continuous_featnames:
-        X_aug[col] = X_aug[col].astype(float)
         X[col] = X[col].astype(float)
+    all_numeric = len(continuous_featnames) > 0 and set(continuous_featnames) == set(X.columns)  # common after preprocessing
 
-    for i in range(num_augmented_samples):
-        og_ind = i % len(X)
-        augdata_i = X.iloc[og_ind].copy()
-        neighbor_i = X.iloc[neigh_ind[og_ind]].copy()
-        # dist_i = neigh_dist[og_ind]
-        cols_toperturb = np.random.choice(list(X.columns), size=np.random.binomial(X.shape[1], p=perturb_prob, size=1)[0], replace=False)
-        for col in cols_toperturb:
-            new_val = neighbor_i[col]
-            if col in continuous_featnames:
-                new_val += np.random.normal(scale=np.abs(augdata_i[col]-new_val)/s)
-            augdata_i[col] = new_val
-        X_aug.iloc[i] = augdata_i
+    og_ind = np.arange(num_augmented_samples) % len(X)
+    Xnp = np.ascontiguousarray(X.to_numpy(), dtype=np.float32) if all_numeric else X.to_numpy()
+    orig = Xnp[og_ind]
+    nbr = Xnp[neigh_ind[og_ind]]
+    # Each feature independently takes its neighbor's value with probability perturb_prob
+    # (equivalent to the former Binomial draw over the number of perturbed columns).
+    perturb_mask = rng.random((num_augmented_samples, X.shape[1])) < perturb_prob
+    cont_col_ind = np.array([X.columns.get_loc(col) for col in continuous_featnames], dtype=int)
+    if _numba_available and np.issubdtype(Xnp.dtype, np.number):
+        cont_col_mask = np.zeros(X.shape[1], dtype=np.bool_)
+        cont_col_mask[cont_col_ind] = True
+        noise = rng.standard_normal(orig.shape)
+        out = np.empty_like(orig)
+        _munge_perturb_kernel(orig, nbr, perturb_mask, cont_col_mask, s, noise, out)
+    elif all_numeric:
+        # every column is continuous, so noise the full matrix without any column indexing;
+        # the noise is drawn fp32 so the output dtype matches the numba path
+        scale_mat = np.abs(orig - nbr)/s  # per-pair noise magnitudes, computed once for all samples
+        noise = rng.standard_normal(scale_mat.shape, dtype=np.float32) * scale_mat
+        out = np.where(perturb_mask, nbr + noise, orig)
+    else:
+        out = np.where(perturb_mask, nbr, orig)
+        if len(cont_col_ind) > 0:
+            orig_cont = orig[:, cont_col_ind].astype(float)
+            nbr_cont = nbr[:, cont_col_ind].astype(float)
+            scale_mat = np.abs(orig_cont - nbr_cont)/s  # per-pair noise magnitudes, computed once for all samples
+            noise = rng.standard_normal(scale_mat.shape) * scale_mat
+            out[:, cont_col_ind] = np.where(perturb_mask[:, cont_col_ind], nbr_cont + noise, orig_cont)
 
+    if all_numeric:
+        return pd.DataFrame(out, columns=X.columns)  # single fp32 block, no dtype fix-up needed
+    X_aug = pd.DataFrame(out, columns=X.columns)
+    for col in X.columns:
+        if X_aug[col].dtype != X[col].dtype:
+            X_aug[col] = X_aug[col].astype(X[col].dtype)
     return X_aug
@@ -36,7 +36,7 @@ MIN_PYTHON_VERSION = '>=3.6.*'
 
 requirements = [
     'Pillow<=6.2.1',
-    'numpy>=1.16.0',
+    'numpy>=1.17.0',
     'scipy>=1.3.3',
     'cython',
     'tornado>=5.0.1',